@@ -32,6 +32,9 @@ setup(
             "pytest-cov>=4.0.0",
             "flake8>=6.0.0",
         ],
+        "fast": [
+            "orjson>=3.8.0",
+        ],
     },
     entry_points={
         "console_scripts": [
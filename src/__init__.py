@@ -9,13 +9,25 @@ file system.
 
 __version__ = "0.1.0"
 
-# Import main components for easier access
-from src.engine import SyncEngine
-from src.fs import LocalStorage
-
 
 # Define public API
 __all__ = [
     "SyncEngine",
     "LocalStorage",
 ]
+
+
+def __getattr__(name):
+    """
+    Import main components on first access.
+
+    Deferring these imports keeps ``import src`` (and ``csync --help``) from
+    loading atlassian-python-api and its dependencies up front.
+    """
+    if name == "SyncEngine":
+        from src.engine import SyncEngine
+        return SyncEngine
+    if name == "LocalStorage":
+        from src.fs import LocalStorage
+        return LocalStorage
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+
+"""
+Confluence client construction for csync.
+
+This module builds the Confluence client used by the sync engine. All requests
+made during a run go through a single pooled HTTP session so that connections
+(and their TLS handshakes) are reused instead of being re-established per call.
+"""
+
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Executor
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from atlassian import Confluence
+from src.jsonio import loads
+
+logger = logging.getLogger(__name__)
+
+# Number of keep-alive connections held open to the Confluence host
+DEFAULT_POOL_SIZE = 20
+
+# Default maximum number of requests sent per second
+DEFAULT_RATE = 50
+
+# Transient failures that are retried with exponential backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Statuses at which POSTs are retried too, since the server refused them
+# without processing them. Other failures are only retried for idempotent
+# methods, as a POST may already have taken effect.
+POST_RETRY_STATUS_CODES = (429, 503)
+
+# Maximum number of retries per request, and the backoff factor between
+# them. urllib3 retries the first failure immediately, then waits
+# backoff * 2 ** (n - 1) seconds before retry n: 2, 4, 8, ... seconds, up
+# to its 120 second cap. A Retry-After header takes precedence.
+RETRY_TOTAL = 8
+RETRY_BACKOFF = 1.0
+
+# Maximum number of files sent in a single attachment upload request
+ATTACHMENT_BATCH_SIZE = 20
+
+# Number of results requested per page from the content search endpoint
+SEARCH_PAGE_SIZE = 250
+
+# Number of results requested per page when listing attachments
+ATTACHMENT_PAGE_SIZE = 100
+
+# Size of the chunks streamed to and from disk for attachments
+CHUNK_SIZE = 1 << 17
+
+# Page properties selecting the new editor and a full width layout
+PAGE_PROPERTIES = {
+    "editor": {"value": "v2"},
+    "content-appearance-draft": {"value": "full-width"},
+    "content-appearance-published": {"value": "full-width"},
+}
+
+
+class RateLimiter:
+    """A thread-safe token bucket limiting how often requests are sent."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        """
+        Initialize the rate limiter.
+
+        Args:
+            rate: The number of tokens added per second.
+            burst: The maximum number of tokens that can accumulate.
+                Defaults to one second worth of tokens.
+        """
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then consume it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class _Retry(Retry):
+    """A retry policy that also retries POSTs refused by a throttled server."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code in POST_RETRY_STATUS_CODES:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """An HTTP adapter that takes a token from a rate limiter per request."""
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, **kwargs):
+        """
+        Initialize the adapter.
+
+        Args:
+            limiter: Optional rate limiter shared by all requests.
+            **kwargs: Passed through to HTTPAdapter.
+        """
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.limiter:
+            self.limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def pool_size_for(concurrency: int) -> int:
+    """
+    Get the connection pool size needed for a number of concurrent workers.
+
+    Pages and their attachments are processed on separate pools of
+    ``concurrency`` workers each, and every paginated listing prefetches
+    its next page on a single thread shared by the pull or push. At most
+    ``2 * concurrency + 1`` requests are therefore in flight at once; the
+    calling thread only makes requests while the page pool is idle. Sizing
+    the pool for all of them keeps urllib3 from opening and discarding
+    connections beyond the pool limit.
+
+    Args:
+        concurrency: The maximum number of pages processed at once.
+
+    Returns:
+        The number of connections to keep open per host.
+    """
+    return max(DEFAULT_POOL_SIZE, 2 * concurrency + 1)
+
+
+def create_session(
+    pool_size: int = DEFAULT_POOL_SIZE, rate: Optional[float] = DEFAULT_RATE
+) -> requests.Session:
+    """
+    Create an HTTP session with a connection pool sized for concurrent use.
+
+    Idempotent requests (GET, PUT, DELETE, ...) failing with a transient
+    status, or with a connection error or read timeout, are retried with
+    exponential backoff on the same pooled connections, honouring any
+    Retry-After header. POSTs, such as page creation and page properties,
+    are only retried when throttled (429) or unavailable (503), as those
+    mean the request wasn't processed. When a rate is given, requests are
+    spread out client-side so concurrent workers don't trip Confluence's
+    rate limits in the first place.
+
+    Args:
+        pool_size: The maximum number of connections to keep open per host.
+        rate: The maximum number of requests per second, or None for no limit.
+
+    Returns:
+        A configured requests session.
+    """
+    session = requests.Session()
+    retries = _Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES,
+        # Wait as long as Confluence asks when it throttles (429/503)
+        respect_retry_after_header=True,
+        # Hand the last response back so the client reports the real error
+        raise_on_status=False,
+    )
+    adapter = RateLimitedAdapter(
+        limiter=RateLimiter(rate) if rate else None,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_client(
+    url: str,
+    username: str,
+    token: str,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    rate: Optional[float] = DEFAULT_RATE,
+) -> Confluence:
+    """
+    Create a Confluence client backed by a shared, pooled HTTP session.
+
+    Args:
+        url: The base URL of the Confluence instance.
+        username: The username for authentication.
+        token: The API token for authentication.
+        pool_size: The maximum number of connections to keep open per host.
+        rate: The maximum number of requests per second, or None for no limit.
+
+    Returns:
+        The Confluence client.
+    """
+    logger.debug("Creating Confluence client for %s (pool size %d)", url, pool_size)
+    return Confluence(
+        url=url,
+        username=username,
+        password=token,
+        cloud=True,
+        session=create_session(pool_size, rate),
+    )
+
+
+def search_content(
+    client: Confluence,
+    cql: str,
+    expand: Optional[str] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    prefetcher: Optional[Executor] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Search for content with CQL, following the pagination cursor.
+
+    A single search with ``expand`` returns the same data as one
+    ``get_page_by_id`` call per result, so whole page trees can be fetched
+    in a handful of requests.
+
+    Args:
+        client: The Confluence client to use.
+        cql: The CQL query to run.
+        expand: Optional comma separated list of properties to expand.
+        limit: The number of results to request per page.
+        prefetcher: Optional executor to request the next page of results
+            on while the current one is processed.
+
+    Yields:
+        Each content item matched by the query.
+    """
+    params = {"cql": cql, "limit": limit}
+    if expand:
+        params["expand"] = expand
+
+    return _paginate(client, "rest/api/content/search", params, prefetcher)
+
+
+def update_page(
+    client: Confluence,
+    page_id: str,
+    title: str,
+    body: str,
+    version: Optional[int] = None,
+    parent_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Replace the title and storage body of an existing page.
+
+    Confluence requires the next version number with every update. Callers
+    that already know the current version (e.g. from a search) should pass
+    it, so the update is a single request instead of a lookup and a write.
+
+    Args:
+        client: The Confluence client to use.
+        page_id: The ID of the page.
+        title: The title of the page.
+        body: The body of the page in storage format.
+        version: The current version number of the page, if known.
+        parent_id: Optional ID of the page to move the page under.
+
+    Returns:
+        The updated page.
+    """
+    if version is None:
+        logger.debug("No version known for page %s, fetching it", page_id)
+        version = client.get_page_by_id(page_id, expand="version")["version"]["number"]
+
+    data = {
+        "id": page_id,
+        "type": "page",
+        "title": title,
+        "body": {"storage": {"value": body, "representation": "storage"}},
+        "version": {"number": version + 1, "minorEdit": True},
+        "metadata": {"properties": PAGE_PROPERTIES},
+    }
+    if parent_id:
+        data["ancestors"] = [{"type": "page", "id": parent_id}]
+
+    response = client.put(
+        f"rest/api/content/{page_id}", data=data, advanced_mode=True
+    )
+    response.raise_for_status()
+    return loads(response.content)
+
+
+def iter_attachments(
+    client: Confluence, page_id: str, prefetcher: Optional[Executor] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    List the attachments of a page, following the pagination cursor.
+
+    Args:
+        client: The Confluence client to use.
+        page_id: The ID of the page.
+        prefetcher: Optional executor to request the next page of
+            attachments on while the current one is processed.
+
+    Yields:
+        The metadata of each attachment.
+    """
+    return _paginate(
+        client,
+        f"rest/api/content/{page_id}/child/attachment",
+        {"limit": ATTACHMENT_PAGE_SIZE, "expand": "version"},
+        prefetcher,
+    )
+
+
+def download_attachment(
+    client: Confluence, attachment: Dict[str, Any], dest_dir: str
+) -> str:
+    """
+    Stream an attachment to disk without buffering it in memory.
+
+    Args:
+        client: The Confluence client to use.
+        attachment: The attachment metadata, as returned by iter_attachments.
+        dest_dir: The directory to save the attachment in.
+
+    Returns:
+        The path of the downloaded file.
+    """
+    url = client.url.rstrip("/") + attachment["_links"]["download"]
+    path = os.path.join(dest_dir, attachment["title"])
+
+    with client.session.get(url, stream=True, timeout=client.timeout) as response:
+        response.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+    return path
+
+
+def upload_attachment(
+    client: Confluence,
+    page_id: str,
+    file_path: str,
+    comment: str = "uploaded by csync",
+) -> Dict[str, Any]:
+    """
+    Stream a file to a page as an attachment without reading it into memory.
+
+    The attachment is created, or a new version is added if one with the
+    same name already exists, in a single request.
+
+    Args:
+        client: The Confluence client to use.
+        page_id: The ID of the page.
+        file_path: The path of the file to upload.
+        comment: The version comment for the attachment.
+
+    Returns:
+        The response from Confluence.
+    """
+    return _put_attachments(client, page_id, [file_path], comment)
+
+
+def upload_attachments(
+    client: Confluence,
+    page_id: str,
+    file_paths: List[str],
+    comment: str = "uploaded by csync",
+) -> None:
+    """
+    Stream several files to a page as attachments in a single request.
+
+    If Confluence rejects the combined request as too large, the files are
+    uploaded one at a time instead.
+
+    Args:
+        client: The Confluence client to use.
+        page_id: The ID of the page.
+        file_paths: The paths of the files to upload, at most
+            ATTACHMENT_BATCH_SIZE of them.
+        comment: The version comment for the attachments.
+    """
+    try:
+        _put_attachments(client, page_id, file_paths, comment)
+    except requests.HTTPError as e:
+        if len(file_paths) == 1 or e.response is None or e.response.status_code != 413:
+            raise
+        logger.debug(
+            "Batch of %d attachments too large for page %s, uploading singly",
+            len(file_paths),
+            page_id,
+        )
+        for file_path in file_paths:
+            upload_attachment(client, page_id, file_path, comment)
+
+
+def _put_attachments(
+    client: Confluence, page_id: str, file_paths: List[str], comment: str
+) -> Dict[str, Any]:
+    """
+    Stream files to a page as attachments in a single request.
+
+    Args:
+        client: The Confluence client to use.
+        page_id: The ID of the page.
+        file_paths: The paths of the files to upload.
+        comment: The version comment for the attachments.
+
+    Returns:
+        The response from Confluence.
+    """
+    url = client.url.rstrip("/") + f"/rest/api/content/{page_id}/child/attachment"
+    # Confluence pairs each file with the comment at the same position
+    fields = [("comment", comment)] * len(file_paths) + [("minorEdit", "true")]
+    with _MultipartFileBody(file_paths, fields) as body:
+        headers = {
+            "Content-Type": body.content_type,
+            "X-Atlassian-Token": "no-check",
+            "Accept": "application/json",
+        }
+        response = client.session.put(
+            url, data=body, headers=headers, timeout=client.timeout
+        )
+
+    response.raise_for_status()
+    return loads(response.content)
+
+
+def _paginate(
+    client: Confluence,
+    path: str,
+    params: Dict[str, Any],
+    prefetcher: Optional[Executor] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over a paginated collection, following the next links.
+
+    The first page is requested directly. With a prefetcher, each further
+    page is requested on it as soon as the previous one arrives, so its
+    round trip overlaps with processing the results already received.
+
+    Args:
+        client: The Confluence client to use.
+        path: The API path of the collection.
+        params: The query parameters for the first page.
+        prefetcher: Optional executor to request the following pages on.
+
+    Yields:
+        Each item in the collection.
+    """
+    def fetch(path: str, params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # Fetch the raw response so the body is decoded with the fast parser
+        response = client.get(path, params=params, advanced_mode=True)
+        response.raise_for_status()
+        return loads(response.content)
+
+    data = fetch(path, params)
+    while data:
+        # The next link already carries the cursor and the original query
+        next_link = data.get("_links", {}).get("next")
+        future = None
+        if next_link and prefetcher:
+            future = prefetcher.submit(fetch, next_link.lstrip("/"), None)
+
+        for result in data.get("results", []):
+            yield result
+
+        if future:
+            data = future.result()
+        elif next_link:
+            data = fetch(next_link.lstrip("/"), None)
+        else:
+            data = None
+
+
+class _MultipartFileBody:
+    """
+    A multipart/form-data request body that streams files from disk.
+
+    requests treats any object with ``read`` and ``__len__`` as a streamed
+    body with a known Content-Length, so the files are sent in chunks rather
+    than loaded into memory. ``seek``/``tell`` let urllib3 rewind the body
+    when a request is retried.
+    """
+
+    def __init__(self, file_paths: List[str], fields: List[Tuple[str, str]]):
+        """
+        Initialize the body.
+
+        Args:
+            file_paths: The paths of the files to send, each in a "file" part.
+            fields: Additional form fields to send before the files.
+        """
+        boundary = uuid.uuid4().hex
+
+        head = ""
+        for key, value in fields:
+            head += (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{key}"\r\n\r\n'
+                f"{value}\r\n"
+            )
+
+        # The body is a sequence of byte strings and open files, each with
+        # the offset it starts at
+        self._parts: List[Tuple[int, Union[bytes, BinaryIO], int]] = []
+        self._size = 0
+        try:
+            for file_path in file_paths:
+                name = os.path.basename(file_path)
+                quoted_name = name.replace('"', "%22")
+                file_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                head += (
+                    f"--{boundary}\r\n"
+                    f'Content-Disposition: form-data; name="file"; '
+                    f'filename="{quoted_name}"\r\n'
+                    f"Content-Type: {file_type}\r\n\r\n"
+                )
+                self._add(head.encode("utf-8"))
+
+                f = open(file_path, "rb")
+                self._add(f, os.fstat(f.fileno()).st_size)
+                head = "\r\n"
+        except BaseException:
+            self.close()
+            raise
+        self._add(f"{head}--{boundary}--\r\n".encode("utf-8"))
+
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._pos = 0
+
+    def _add(self, part: Union[bytes, BinaryIO], size: Optional[int] = None) -> None:
+        """
+        Append a part to the body.
+
+        Args:
+            part: The bytes or open file to append.
+            size: The size of the file, for files.
+        """
+        if size is None:
+            size = len(part)
+        self._parts.append((self._size, part, size))
+        self._size += size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __enter__(self) -> "_MultipartFileBody":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the underlying files."""
+        for _, part, _ in self._parts:
+            if not isinstance(part, bytes):
+                part.close()
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        self._pos = max(0, min(offset, len(self)))
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = len(self) - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+
+        data = bytearray()
+        for start, part, part_size in self._parts:
+            if size <= 0:
+                break
+            offset = self._pos - start
+            if not 0 <= offset < part_size:
+                continue
+
+            n = min(size, part_size - offset)
+            if isinstance(part, bytes):
+                chunk = part[offset:offset + n]
+            else:
+                part.seek(offset)
+                chunk = part.read(n)
+                if not chunk:
+                    raise IOError(f"{part.name} was truncated during upload")
+            data += chunk
+            self._pos += len(chunk)
+            size -= len(chunk)
+
+        return bytes(data)
@@ -7,14 +7,15 @@ This module provides the core functionality for syncing Confluence pages.
 """
 
 import logging
-from pathlib import Path
+import os
+from functools import cached_property
 from typing import Dict
 from atlassian import Confluence
-from urllib.parse import urlparse
 
-from src.fs import LocalStorage
-from src.pull import PullOperations
+from src.fs import ContentCache, LocalStorage
+from src.pull import DEFAULT_CONCURRENCY, PullOperations
 from src.push import PushOperations
+from src.urls import parse_page_url
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,10 @@ class SyncEngine:
         show_progress: bool = True,
         recurse: bool = True,
         dry_run: bool = False,
+        use_cache: bool = True,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        force: bool = False,
+        trust_versions: bool = False,
     ):
         """
         Initialize the sync engine.
@@ -40,27 +45,60 @@ class SyncEngine:
             show_progress: Whether to show progress bars.
             recurse: Whether to recursively process child pages.
             dry_run: Whether to perform a dry run (no changes).
+            use_cache: Whether to cache pulled page content by version.
+            concurrency: The maximum number of pages processed at once.
+            force: Whether to push pages even if they are unchanged since
+                the last push.
+            trust_versions: Whether pulls skip pages and subtrees whose
+                versions are unchanged, missing attachments that changed
+                without a page edit.
         """
         self.client = client
         self.show_progress = show_progress
         self.recurse = recurse
         self.dry_run = dry_run
-
-        # Initialize operations
-        self.pull_ops = PullOperations(
-            client=client, 
-            show_progress=show_progress, 
-            recurse=recurse, 
-            dry_run=dry_run
+        self.use_cache = use_cache
+        self.concurrency = concurrency
+        self.force = force
+        self.trust_versions = trust_versions
+
+    @cached_property
+    def pull_ops(self) -> PullOperations:
+        """The pull operations, created on first use."""
+        return PullOperations(
+            client=self.client,
+            show_progress=self.show_progress,
+            recurse=self.recurse,
+            dry_run=self.dry_run,
+            cache=ContentCache(site=self.client.url) if self.use_cache else None,
+            concurrency=self.concurrency,
+            trust_versions=self.trust_versions,
         )
 
-        self.push_ops = PushOperations(
-            client=client, 
-            show_progress=show_progress, 
-            recurse=recurse, 
-            dry_run=dry_run
+    @cached_property
+    def push_ops(self) -> PushOperations:
+        """The push operations, created on first use."""
+        return PushOperations(
+            client=self.client,
+            show_progress=self.show_progress,
+            recurse=self.recurse,
+            dry_run=self.dry_run,
+            concurrency=self.concurrency,
+            force=self.force,
         )
 
+    def close(self) -> None:
+        """
+        Shut down the worker pools of the operations created so far.
+
+        The operations are dropped as well, so a later pull or push creates
+        them again with fresh pools.
+        """
+        for name in ("pull_ops", "push_ops"):
+            ops = self.__dict__.pop(name, None)
+            if ops is not None:
+                ops.close()
+
     def push(self, source: str, destination: str) -> None:
         """
         Push local pages to Confluence.
@@ -70,17 +108,24 @@ class SyncEngine:
             destination: The URL of the Confluence page or space to push to.
         """
         # Parse the destination URL to get page ID
-        parsed = self.parse_page_url(destination)
-        page_id = parsed["page_id"]
+        parsed = parse_page_url(destination)
+        page_id = parsed.page_id
+        if not page_id:
+            raise ValueError(f"No page ID found in URL: {destination}")
 
         # Push to the specified parent page
         storage = LocalStorage(source)
-        local_dir = Path(source)
-        self.push_ops.push_page_tree(
-            storage=storage,
-            local_dir=local_dir,
-            parent_id=page_id,
-        )
+        # Walk the tree with plain string paths, which join faster than Path
+        local_dir = os.fspath(source)
+        try:
+            self.push_ops.push_page_tree(
+                storage=storage,
+                local_dir=local_dir,
+                parent_id=page_id,
+            )
+        finally:
+            storage.flush()
+            self.close()
 
     def pull(self, source: str, destination: str) -> Dict[str, int]:
         """
@@ -95,70 +140,25 @@ class SyncEngine:
             A dictionary containing sync statistics.
         """
         # Parse the source URL to get page ID
-        parsed = self.parse_page_url(source)
-        page_id = parsed["page_id"]
+        parsed = parse_page_url(source)
+        page_id = parsed.page_id
+        if not page_id:
+            raise ValueError(f"No page ID found in URL: {source}")
         
         # Initialize local storage
         storage = LocalStorage(destination)
         
         if self.dry_run:
-            logger.info(f"Dry run - would pull page tree from {page_id}")
+            logger.info("Dry run - would pull page tree from %s", page_id)
             return {"pulled": 0}
         
         # Simply pull the page tree recursively
-        logger.info(f"Pulling page tree from {page_id}")
-        self.pull_ops.pull_page_tree(page_id, storage)
+        logger.info("Pulling page tree from %s", page_id)
+        try:
+            self.pull_ops.pull_page_tree(page_id, storage)
+        finally:
+            # Persist the pages recorded during the pull, even on failure
+            storage.flush()
+            self.close()
         
         return {"pulled": 1}  # Basic stats, could be enhanced if needed
-
-    def parse_page_url(self, url: str) -> Dict[str, str]:
-        """
-        Parse a Confluence page URL to extract space key and page title/ID.
-
-        Args:
-            url: The URL of the Confluence page.
-
-        Returns:
-            A dictionary containing the parsed components.
-        """
-        parsed = urlparse(url)
-        path_parts = parsed.path.strip("/").split("/")
-
-        # Initialize result with defaults
-        result = {
-            "base_url": f"{parsed.scheme}://{parsed.netloc}",
-            "type": "page",
-            "space_key": None,
-            "page_id": None,
-            "title": None,
-        }
-
-        # Extract space key, page ID, and title from the URL
-        if (
-            len(path_parts) >= 3
-            and path_parts[0] == "wiki"
-            and path_parts[1] == "spaces"
-        ):
-            # Space key is always the third part
-            result["space_key"] = path_parts[2]
-
-            # Page ID and title if they exist
-            if len(path_parts) >= 5 and path_parts[3] == "pages":
-                result["page_id"] = path_parts[4]
-                if len(path_parts) >= 6:
-                    result["title"] = path_parts[5]
-
-        # Handle direct API URLs (for compatibility)
-        elif (
-            len(path_parts) >= 4
-            and path_parts[0] == "rest"
-            and path_parts[1] == "api"
-            and path_parts[2] == "content"
-        ):
-            result["page_id"] = path_parts[3]
-            # We'll need to fetch the space key from the page itself later
-
-        # Debug output
-        print(f"Final parsed result: {result}")
-
-        return result
@@ -6,9 +6,224 @@ File system operations for csync.
 This module provides functions for interacting with the local file system.
 """
 
-import json
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Set, Tuple, Union
+from src.jsonio import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+
+def _get_umask() -> int:
+    """
+    Get the process umask.
+
+    Returns:
+        The umask.
+    """
+    # The umask can only be read by setting it, so set it straight back
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The mode open() gives new files. Files written atomically start out as
+# private temporary files, so they are given this mode before being moved
+# into place. The umask is read once, as reading it briefly changes it.
+FILE_MODE = 0o666 & ~_get_umask()
+
+
+def default_cache_dir() -> Path:
+    """
+    Get the default directory for cached page content.
+
+    Returns:
+        The path to the cache directory.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "csync" / "pages"
+
+
+# Maximum number of page versions kept in the content cache of a site
+MAX_CACHE_ENTRIES = 10000
+
+
+class ContentCache:
+    """
+    Caches page content on disk, keyed by page ID and version number.
+
+    Page IDs are only unique within a Confluence site, so each site gets its
+    own subdirectory of the cache. The cache is pruned when it is opened:
+    versions superseded by a newer cached version of the same page are
+    removed, and beyond max_entries the least recently written entries are.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        site: Optional[str] = None,
+        max_entries: int = MAX_CACHE_ENTRIES,
+    ):
+        """
+        Initialize the content cache.
+
+        Args:
+            cache_dir: The directory for cached content. Defaults to
+                ~/.cache/csync/pages.
+            site: The base URL of the Confluence site the pages belong to.
+            max_entries: The maximum number of page versions kept.
+        """
+        cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        if site:
+            # e.g. https://example.atlassian.net/wiki -> example.atlassian.net_wiki
+            cache_dir = cache_dir / sanitize_filename(
+                site.split("://", 1)[-1].rstrip("/")
+            )
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._prune()
+
+    def _prune(self) -> None:
+        """Remove superseded page versions and the oldest excess entries."""
+        # The newest cached version of each page, with its mtime
+        latest: Dict[str, Tuple[int, str, float]] = {}
+        stale = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                page_id, sep, rest = entry.name.partition(".v")
+                version = rest[: -len(".html")]
+                if not sep or not rest.endswith(".html") or not version.isdigit():
+                    continue
+
+                newest = latest.get(page_id)
+                if newest is None or int(version) > newest[0]:
+                    if newest is not None:
+                        stale.append(newest[1])
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    latest[page_id] = (int(version), entry.path, mtime)
+                else:
+                    stale.append(entry.path)
+
+        if len(latest) > self.max_entries:
+            by_age = sorted(latest.values(), key=lambda cached: cached[2])
+            excess = len(by_age) - self.max_entries
+            stale.extend(path for _, path, _ in by_age[:excess])
+
+        for path in stale:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                logger.debug("Could not remove cache entry %s: %s", path, e)
+
+    def _path(self, page_id: str, version: int) -> str:
+        """
+        Get the cache file path for a page version.
+
+        Args:
+            page_id: The ID of the page.
+            version: The version number of the page.
+
+        Returns:
+            The path to the cache file.
+        """
+        return os.path.join(self.cache_dir, f"{page_id}.v{version}.html")
+
+    def contains(self, page_id: str, version: int) -> bool:
+        """
+        Check whether a page version is cached.
+
+        Args:
+            page_id: The ID of the page.
+            version: The version number of the page.
+
+        Returns:
+            True if the content of the page version is cached.
+        """
+        return os.path.exists(self._path(page_id, version))
+
+    def get(self, page_id: str, version: int) -> Optional[str]:
+        """
+        Get the cached content of a page version.
+
+        Args:
+            page_id: The ID of the page.
+            version: The version number of the page.
+
+        Returns:
+            The HTML content of the page, or None if it is not cached.
+        """
+        # Entries may be pruned by another run, so don't check beforehand
+        try:
+            with open(self._path(page_id, version), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, page_id: str, version: int, content: str) -> None:
+        """
+        Cache the content of a page version.
+
+        The content is written to a temporary file first and moved into
+        place, so readers never see a partially written entry.
+
+        Args:
+            page_id: The ID of the page.
+            version: The version number of the page.
+            content: The HTML content of the page.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.chmod(tmp_path, FILE_MODE)
+            os.replace(tmp_path, self._path(page_id, version))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def content_hash(content: str) -> str:
+    """
+    Get the digest of a page's content.
+
+    Args:
+        content: The HTML content of the page.
+
+    Returns:
+        The hex digest of the content.
+    """
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Characters that are invalid in filenames, mapped to underscores
+_SANITIZE_TABLE = str.maketrans({char: "_" for char in '<>:"/\\|?*'})
+
+
+@lru_cache(maxsize=4096)
+def sanitize_filename(filename: str) -> str:
+    """
+    Sanitize a filename to be safe for the file system.
+
+    Invalid characters are replaced with underscores in a single pass and
+    the result is limited to 255 characters. Results are memoized, since
+    the same titles are sanitized repeatedly during a sync.
+
+    Args:
+        filename: The filename to sanitize.
+
+    Returns:
+        A sanitized filename.
+    """
+    return filename.translate(_SANITIZE_TABLE)[:255]
 
 
 class LocalStorage:
@@ -31,53 +246,246 @@ class LocalStorage:
         # Initialize or load the ID-to-path mapping
         self.id_map_file = self.metadata_dir / "id_map.json"
         if self.id_map_file.exists():
-            with open(self.id_map_file, "r", encoding="utf-8") as f:
-                self.id_map = json.load(f)
+            with open(self.id_map_file, "rb") as f:
+                self.id_map = loads(f.read())
         else:
             self.id_map = {}
 
+        # Whether the ID map has changed since it was last written to disk
+        self._dirty = False
+
+        # Digests of the remote subtrees below each page, as of the last
+        # pull that completed them
+        self.subtree_hashes_file = self.metadata_dir / "subtree_hashes.json"
+        if self.subtree_hashes_file.exists():
+            with open(self.subtree_hashes_file, "rb") as f:
+                self.subtree_hashes = loads(f.read())
+        else:
+            self.subtree_hashes = {}
+        self._subtree_hashes_dirty = False
+
+        # What was last pushed from each page directory, keyed by its path
+        # relative to the base directory
+        self.push_state_file = self.metadata_dir / "push_state.json"
+        if self.push_state_file.exists():
+            with open(self.push_state_file, "rb") as f:
+                self.push_state = loads(f.read())
+        else:
+            self.push_state = {}
+        self._push_state_dirty = False
+
+        # Whether the ID map has been rebuilt from the pages on disk this run.
+        # This happens lazily on the first lookup that misses, so runs that
+        # never look pages up by ID (e.g. pushes) don't walk the tree.
+        self._id_map_rebuilt = False
+
+        # Guards the ID map, which page workers update concurrently
+        self._id_map_lock = threading.Lock()
+
+        # Pages recorded with set_id during this run, which a rebuild keeps
+        # even if their metadata isn't on disk yet
+        self._recorded_ids: Dict[str, str] = {}
+
+        # Metadata files that couldn't be read when rebuilding the ID map
+        self._bad_files: Set[str] = set()
+
+        # Directories created (or found to exist) during this run
+        self._created_dirs: Set[Path] = set()
+
+        # Parsed metadata files, keyed by path, with the mtime they were read at
+        self._meta_cache: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
     def get_page_dir_by_id(self, page_id: str) -> Optional[Path]:
         """
         Get the directory for a page by its ID.
 
+        The directory isn't checked for existence here; readers such as
+        get_page_metadata_by_id detect stale entries when they read it.
+
         Args:
             page_id: The ID of the page.
 
         Returns:
             The path to the page directory, or None if not found.
         """
-        # Check the ID-to-path mapping
-        if page_id in self.id_map:
-            path = Path(self.id_map[page_id])
-            if path.exists():
-                return path
+        # The map is missing the page, so rebuild it once from the pages on
+        # disk rather than searching the tree on every miss
+        if page_id not in self.id_map and not self._id_map_rebuilt:
+            self._rebuild_id_map()
 
-        # If not found in map or path doesn't exist, search all metadata files
-        for metadata_file in self.base_dir.glob("**/metadata.json"):
-            try:
-                with open(metadata_file, "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-                    if metadata.get("id") == page_id:
-                        # Update the map with the found path
-                        path = metadata_file.parent
-                        self.update_id_map(page_id, str(path))
-                        return path
-            except:
-                continue
+        path = self.id_map.get(page_id)
+        return Path(path) if path else None
+
+    def get_page_metadata_by_id(self, page_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the metadata of a locally stored page by its ID.
 
-        return None
+        Args:
+            page_id: The ID of the page.
 
-    def update_id_map(self, page_id: str, path: str) -> None:
+        Returns:
+            The metadata of the page, or None if it isn't stored locally.
         """
-        Update the ID-to-path mapping.
+        page_dir = self.get_page_dir_by_id(page_id)
+        if page_dir is None:
+            return None
+
+        metadata = self.get_page_metadata(page_dir)
+        if metadata is None and not self._id_map_rebuilt:
+            # The mapped directory is gone, so the map is stale
+            self._rebuild_id_map()
+            page_dir = self.get_page_dir_by_id(page_id)
+            if page_dir is not None:
+                metadata = self.get_page_metadata(page_dir)
+
+        return metadata
+
+    def _rebuild_id_map(self) -> None:
+        """
+        Rebuild the ID-to-path mapping with a single walk of the tree.
+
+        Pages recorded with set_id during this run are kept, and the walk
+        holds the map's lock, so none are lost when the map is replaced.
+        Only the first of several concurrent callers walks.
+        """
+        with self._id_map_lock:
+            if not self._id_map_rebuilt:
+                self._walk_id_map()
+
+    def _walk_id_map(self) -> None:
+        """Replace the ID-to-path mapping with the pages found on disk."""
+        id_map = {}
+        stack = [os.fspath(self.base_dir)]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.name != ".csync":
+                            stack.append(entry.path)
+                    elif (
+                        entry.name == "metadata.json"
+                        and entry.path not in self._bad_files
+                    ):
+                        try:
+                            with open(entry.path, "rb") as f:
+                                metadata = loads(f.read())
+                        except (OSError, ValueError) as e:
+                            # Remember unreadable files so they are only
+                            # reported once rather than on every rebuild
+                            logger.warning("Skipping %s: %s", entry.path, e)
+                            self._bad_files.add(entry.path)
+                            continue
+                        if isinstance(metadata, dict) and metadata.get("id"):
+                            id_map[metadata["id"]] = os.path.dirname(entry.path)
+
+        id_map.update(self._recorded_ids)
+        self.id_map = id_map
+        self._id_map_rebuilt = True
+        self._dirty = True
+
+    def set_id(self, page_id: str, path: str) -> None:
+        """
+        Record the directory of a page in the ID-to-path mapping.
+
+        The mapping is only changed in memory; call flush() to persist it.
 
         Args:
             page_id: The ID of the page.
             path: The path to the page directory.
         """
-        self.id_map[page_id] = path
-        with open(self.id_map_file, "w", encoding="utf-8") as f:
-            json.dump(self.id_map, f, indent=2, ensure_ascii=False)
+        with self._id_map_lock:
+            self._recorded_ids[page_id] = path
+            if self.id_map.get(page_id) != path:
+                self.id_map[page_id] = path
+                self._dirty = True
+
+    def get_subtree_hash(self, page_id: str) -> Optional[str]:
+        """
+        Get the digest of the subtree below a page as of the last pull.
+
+        Args:
+            page_id: The ID of the page.
+
+        Returns:
+            The digest, or None if the subtree was never completely pulled.
+        """
+        return self.subtree_hashes.get(page_id)
+
+    def set_subtree_hashes(self, hashes: Dict[str, str]) -> None:
+        """
+        Record the digests of completely pulled subtrees.
+
+        The digests are only changed in memory; call flush() to persist them.
+
+        Args:
+            hashes: The digests keyed by the ID of each subtree's root page.
+        """
+        self.subtree_hashes.update(hashes)
+        self._subtree_hashes_dirty = True
+
+    def get_push_state(self, page_dir: Union[str, Path]) -> Optional[Dict[str, Any]]:
+        """
+        Get what was last pushed from a page directory.
+
+        Args:
+            page_dir: The directory of the page.
+
+        Returns:
+            The page ID, version, content digest and attachment stats as of
+            the last push, or None if the page was never pushed.
+        """
+        return self.push_state.get(os.path.relpath(page_dir, self.base_dir))
+
+    def set_push_state(self, page_dir: Union[str, Path], state: Dict[str, Any]) -> None:
+        """
+        Record what was pushed from a page directory.
+
+        The state is only changed in memory; call flush() to persist it.
+
+        Args:
+            page_dir: The directory of the page.
+            state: The page ID, version, content digest and attachment stats.
+        """
+        self.push_state[os.path.relpath(page_dir, self.base_dir)] = state
+        self._push_state_dirty = True
+
+    def flush(self) -> None:
+        """
+        Write the ID-to-path mapping, subtree digests and push state to disk
+        if changed.
+        """
+        if self._dirty:
+            self._write_json(self.id_map_file, self.id_map)
+            self._dirty = False
+
+        if self._subtree_hashes_dirty:
+            self._write_json(self.subtree_hashes_file, self.subtree_hashes)
+            self._subtree_hashes_dirty = False
+
+        if self._push_state_dirty:
+            self._write_json(self.push_state_file, self.push_state)
+            self._push_state_dirty = False
+
+    def _write_json(self, path: Union[str, Path], obj: Any) -> None:
+        """
+        Write an object to a JSON file atomically.
+
+        The JSON is written to a temporary file first and moved into place,
+        so an interrupted write never leaves a truncated file behind.
+
+        Args:
+            path: The path of the file.
+            obj: The object to write.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dumps(obj, indent=True))
+            os.chmod(tmp_path, FILE_MODE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     def get_page_dir(self, title: str) -> Path:
         """
@@ -116,6 +524,17 @@ class LocalStorage:
         child_dir = parent_dir / "children" / safe_title
         return child_dir
 
+    def make_dir(self, path: Path) -> None:
+        """
+        Create a directory and its parents, at most once per run.
+
+        Args:
+            path: The directory to create.
+        """
+        if path not in self._created_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path)
+
     def save_page_content(self, page_dir: Path, content: str) -> None:
         """
         Save the content of a page.
@@ -125,7 +544,7 @@ class LocalStorage:
             content: The HTML content of the page.
         """
         # Create the page directory if it doesn't exist
-        page_dir.mkdir(parents=True, exist_ok=True)
+        self.make_dir(page_dir)
 
         # Write the content to a file
         with open(page_dir / "content.html", "w", encoding="utf-8") as f:
@@ -140,13 +559,20 @@ class LocalStorage:
             metadata: The metadata of the page.
         """
         # Create the page directory if it doesn't exist
-        page_dir.mkdir(parents=True, exist_ok=True)
+        self.make_dir(page_dir)
 
-        # Write the metadata to a file
-        with open(page_dir / "metadata.json", "w", encoding="utf-8") as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        # Write the metadata to a file, atomically so an interrupted pull
+        # never leaves a truncated file for the next run to trip over
+        metadata_file = os.path.join(page_dir, "metadata.json")
+        self._write_json(metadata_file, metadata)
 
-    def get_page_metadata(self, page_dir: Path) -> Optional[Dict[str, Any]]:
+        self._meta_cache[metadata_file] = (os.stat(metadata_file).st_mtime_ns, metadata)
+        if "id" in metadata:
+            self.set_id(metadata["id"], str(page_dir))
+
+    def get_page_metadata(
+        self, page_dir: Union[str, Path]
+    ) -> Optional[Dict[str, Any]]:
         """
         Get the metadata of a page.
 
@@ -156,14 +582,41 @@ class LocalStorage:
         Returns:
             The metadata of the page, or None if not found.
         """
-        metadata_file = page_dir / "metadata.json"
-        if not metadata_file.exists():
+        metadata_file = os.path.join(page_dir, "metadata.json")
+        try:
+            mtime = os.stat(metadata_file).st_mtime_ns
+        except FileNotFoundError:
+            self._meta_cache.pop(metadata_file, None)
+            return None
+
+        # Only parse the file again if it changed since it was last read
+        cached = self._meta_cache.get(metadata_file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(metadata_file, "rb") as f:
+            metadata = loads(f.read())
+
+        self._meta_cache[metadata_file] = (mtime, metadata)
+        return metadata
+
+    def get_page_version(self, page_id: str) -> Optional[int]:
+        """
+        Get the version number of the locally stored copy of a page.
+
+        Args:
+            page_id: The ID of the page.
+
+        Returns:
+            The version number, or None if the page isn't stored locally.
+        """
+        metadata = self.get_page_metadata_by_id(page_id)
+        if not metadata:
             return None
 
-        with open(metadata_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return metadata.get("version", {}).get("number")
 
-    def get_page_content(self, page_dir: Path) -> Optional[str]:
+    def get_page_content(self, page_dir: Union[str, Path]) -> Optional[str]:
         """
         Get the content of a page.
 
@@ -173,13 +626,12 @@ class LocalStorage:
         Returns:
             The HTML content of the page, or None if not found.
         """
-        content_file = page_dir / "content.html"
-        if not content_file.exists():
+        try:
+            with open(os.path.join(page_dir, "content.html"), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
             return None
 
-        with open(content_file, "r", encoding="utf-8") as f:
-            return f.read()
-
     def _sanitize_filename(self, filename: str) -> str:
         """
         Sanitize a filename to be safe for the file system.
@@ -190,13 +642,5 @@ class LocalStorage:
         Returns:
             A sanitized filename.
         """
-        # Replace invalid characters with underscores
-        invalid_chars = '<>:"/\\|?*'
-        for char in invalid_chars:
-            filename = filename.replace(char, "_")
-
-        # Limit the length of the filename
-        if len(filename) > 255:
-            filename = filename[:255]
+        return sanitize_filename(filename)
 
-        return filename
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+JSON encoding and decoding for csync.
+
+This module uses orjson when it is installed (``pip install csync[fast]``)
+and falls back to the standard library otherwise.
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decode a JSON document.
+
+    Args:
+        data: The JSON document, as bytes or text.
+
+    Returns:
+        The decoded object.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    Encode an object as UTF-8 JSON.
+
+    Args:
+        obj: The object to encode.
+        indent: Whether to pretty-print with two-space indentation.
+
+    Returns:
+        The encoded JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(
+        obj, indent=2 if indent else None, ensure_ascii=False
+    ).encode("utf-8")
@@ -12,8 +12,6 @@ import os
 import logging
 import click
 from dotenv import load_dotenv
-from atlassian import Confluence
-from src.engine import SyncEngine
 
 # Required environment variables
 REQUIRED_ENV_VARS = {
@@ -45,8 +43,16 @@ def check_environment():
               help="Process child pages recursively")
 @click.option("--dry-run", is_flag=True,
               help="Preview changes without making any modifications")
+@click.option("--no-cache", is_flag=True,
+              help="Bypass the local cache of pulled page content")
+@click.option("--concurrency", default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help="Maximum number of pages processed concurrently")
+@click.option("--rate", default=50, show_default=True,
+              type=click.FloatRange(min=0),
+              help="Maximum Confluence requests per second (0 for no limit)")
 @click.pass_context
-def cli(ctx, progress, recurse, dry_run):
+def cli(ctx, progress, recurse, dry_run, no_cache, concurrency, rate):
     """
     csync - Synchronize Confluence pages with your local filesystem.
 
@@ -79,6 +85,9 @@ def cli(ctx, progress, recurse, dry_run):
         "PROGRESS": progress,
         "RECURSE": recurse,
         "DRY_RUN": dry_run,
+        "CACHE": not no_cache,
+        "CONCURRENCY": concurrency,
+        "RATE": rate or None,
         "CONFLUENCE_URL": os.environ["CONFLUENCE_URL"],
         "CONFLUENCE_USERNAME": os.environ["CONFLUENCE_USERNAME"],
         "ATLASSIAN_TOKEN": os.environ["ATLASSIAN_TOKEN"]
@@ -90,8 +99,11 @@ def cli(ctx, progress, recurse, dry_run):
 @click.argument("destination", required=True, type=click.Path())
 @click.option("--recurse/--no-recurse", default=True,
               help="Process child pages recursively")
+@click.option("--trust-versions", is_flag=True,
+              help="Skip pages whose version is unchanged, without checking "
+                   "their attachments for changes")
 @click.pass_context
-def pull(ctx, source, destination, recurse):
+def pull(ctx, source, destination, recurse, trust_versions):
     """
     Pull Confluence pages to your local filesystem.
 
@@ -111,21 +123,29 @@ def pull(ctx, source, destination, recurse):
     Preview changes without pulling:
     $ csync --dry-run pull "https://<confluence-url>/wiki/spaces/SPACE/pages/123" ./docs
     """
+    # Deferred so that --help never loads the Confluence client stack
+    from src.client import create_client, pool_size_for
+    from src.engine import SyncEngine
+
     try:
         # Create the destination directory if it doesn't exist
         os.makedirs(destination, exist_ok=True)
 
         # Initialize the sync engine
         engine = SyncEngine(
-            client=Confluence(
+            client=create_client(
                 url=ctx.obj["CONFLUENCE_URL"],
                 username=ctx.obj["CONFLUENCE_USERNAME"],
-                password=ctx.obj["ATLASSIAN_TOKEN"],
-                cloud=True,
+                token=ctx.obj["ATLASSIAN_TOKEN"],
+                rate=ctx.obj["RATE"],
+                pool_size=pool_size_for(ctx.obj["CONCURRENCY"]),
             ),
             show_progress=ctx.obj["PROGRESS"],
             recurse=recurse,  # Use the command-level recurse parameter
             dry_run=ctx.obj["DRY_RUN"],
+            use_cache=ctx.obj["CACHE"],
+            concurrency=ctx.obj["CONCURRENCY"],
+            trust_versions=trust_versions,
         )
 
         # Perform the pull operation
@@ -146,9 +166,11 @@ def pull(ctx, source, destination, recurse):
 @click.argument("destination", required=True)
 @click.option("--recurse/--no-recurse", default=True,
               help="Process child pages recursively")
+@click.option("--force", is_flag=True,
+              help="Push pages and attachments even if unchanged since the last push")
 @click.option("--debug", is_flag=True, help="Enable debug logging")
 @click.pass_context
-def push(ctx, source, destination, recurse, debug):
+def push(ctx, source, destination, recurse, force, debug):
     """
     Push local changes back to Confluence.
 
@@ -167,11 +189,19 @@ def push(ctx, source, destination, recurse, debug):
     \b
     Preview changes without pushing:
     $ csync --dry-run push ./docs "https://<confluence-url>/wiki/spaces/SPACE/pages/123"
+
+    \b
+    Push every page, even those unchanged since the last push:
+    $ csync push --force ./docs "https://<confluence-url>/wiki/spaces/SPACE/pages/123"
     
     \b
     Enable debug logging:
     $ csync push --debug ./docs "https://<confluence-url>/wiki/spaces/SPACE/pages/123"
     """
+    # Deferred so that --help never loads the Confluence client stack
+    from src.client import create_client, pool_size_for
+    from src.engine import SyncEngine
+
     try:
         # Set up logging
         if debug:
@@ -191,11 +221,12 @@ def push(ctx, source, destination, recurse, debug):
             
         # Initialize the sync engine
         try:
-            client = Confluence(
+            client = create_client(
                 url=ctx.obj["CONFLUENCE_URL"],
                 username=ctx.obj["CONFLUENCE_USERNAME"],
-                password=ctx.obj["ATLASSIAN_TOKEN"],
-                cloud=True,
+                token=ctx.obj["ATLASSIAN_TOKEN"],
+                rate=ctx.obj["RATE"],
+                pool_size=pool_size_for(ctx.obj["CONCURRENCY"]),
             )
                 
             engine = SyncEngine(
@@ -203,6 +234,8 @@ def push(ctx, source, destination, recurse, debug):
                 show_progress=ctx.obj["PROGRESS"],
                 recurse=recurse,  # Use the command-level recurse parameter
                 dry_run=ctx.obj["DRY_RUN"],
+                concurrency=ctx.obj["CONCURRENCY"],
+                force=force,
             )
         except Exception as e:
             click.echo(f"Error initializing Confluence client: {str(e)}", err=True)
@@ -6,17 +6,34 @@ Pull operations for csync.
 This module provides functionality for pulling Confluence pages to local storage.
 """
 
+import hashlib
 import logging
-import io
-import sys
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Optional, List, Dict, Tuple
 from tqdm import tqdm
-from src.fs import LocalStorage
+from src.client import download_attachment, iter_attachments, search_content
+from src.fs import ContentCache, LocalStorage, content_hash
 from atlassian import Confluence
 
 logger = logging.getLogger(__name__)
 
+# Properties expanded on every page fetched from Confluence
+PAGE_EXPAND = (
+    "version,space,"
+    "metadata.properties.editor,metadata.properties.emoji_title_published"
+)
+
+# Expansion for the storage-format body of a page
+BODY_EXPAND = "body.storage"
+
+# Default number of pages pulled concurrently
+DEFAULT_CONCURRENCY = 8
+
+# Number of page IDs per search when fetching uncached page bodies
+BODY_BATCH_SIZE = 100
+
 # Configure tqdm to work properly with terminal output
 tqdm.monitor_interval = 0  # Disable monitor thread to avoid issues
 
@@ -30,6 +47,9 @@ class PullOperations:
         show_progress: bool = True,
         recurse: bool = True,
         dry_run: bool = False,
+        cache: Optional[ContentCache] = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        trust_versions: bool = False,
     ):
         """
         Initialize the pull operations.
@@ -39,11 +59,42 @@ class PullOperations:
             show_progress: Whether to show progress bars.
             recurse: Whether to recursively process child pages.
             dry_run: Whether to perform a dry run (no changes).
+            cache: Optional cache of page content keyed by version.
+            concurrency: The maximum number of pages pulled at once.
+            trust_versions: Whether to skip pages, and whole subtrees, whose
+                versions are unchanged since the last pull. Confluence
+                doesn't bump the version of a page when its attachments
+                change, so attachments added or replaced since are missed.
         """
         self.client = client
         self.show_progress = show_progress
         self.recurse = recurse
         self.dry_run = dry_run
+        self.cache = cache
+        self.concurrency = concurrency
+        self.trust_versions = trust_versions
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Attachments are downloaded from within page workers, so they get
+        # their own pool rather than waiting on tasks in the page pool
+        self.attachment_executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Later pages of paginated listings are requested on a single shared
+        # thread, rather than one per listing
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+        # Whether an attachment download failed during the current pull
+        self.attachments_failed = False
+
+        # Bodies are left out of the tree fetch and only requested later
+        # for pages that are neither cached nor already up to date locally
+        self.page_expand = PAGE_EXPAND
+
+    def close(self) -> None:
+        """Shut down the worker pools, waiting for any running tasks."""
+        self.executor.shutdown()
+        self.attachment_executor.shutdown()
+        self.prefetcher.shutdown()
 
     def pull_page(
         self,
@@ -65,35 +116,110 @@ class PullOperations:
             The path to the page directory.
         """
         if self.dry_run:
-            logger.info(f"Would pull page {page_id}")
+            logger.info("Would pull page %s", page_id)
             return Path()
 
         # If metadata wasn't provided, fetch it
         if not metadata:
-            page = self.client.get_page_by_id(
-                page_id,
-                expand="body.storage,version,space,metadata.properties.editor,metadata.properties.emoji_title_published"
-            )
+            page = self.client.get_page_by_id(page_id, expand=self.page_expand)
             metadata = page
 
-        # Get the page content
-        content = metadata['body']['storage']['value']
-
         # Determine the page directory
         if parent_dir:
             page_dir = storage.get_child_dir(parent_dir, metadata['title'])
         else:
             page_dir = storage.get_page_dir(metadata['title'])
 
-        # Save the content and metadata
-        storage.save_page_content(page_dir, content)
-        storage.save_page_metadata(page_dir, metadata)
+        local = storage.get_page_metadata(page_dir)
+        if local and local.get('id') != page_id:
+            local = None
+        unchanged = (
+            local is not None
+            and local.get('version', {}).get('number') == metadata['version']['number']
+            and 'content_hash' in local
+        )
 
-        # Pull attachments
-        self.pull_attachments(page_id, page_dir)
+        # When trusting versions, skip the attachment listing as well if
+        # all of the page's attachments came down last time
+        if unchanged and self.trust_versions and local.get('attachments_complete'):
+            logger.debug("Page %s is unchanged, skipping", page_id)
+            storage.set_id(page_id, str(page_dir))
+            return page_dir
+
+        # Save the content, unless it is identical to what was last pulled
+        # (e.g. only the title or properties changed)
+        if unchanged:
+            digest = local['content_hash']
+        else:
+            content = self.get_page_content(page_id, metadata)
+            digest = content_hash(content)
+            if not local or local.get('content_hash') != digest:
+                storage.save_page_content(page_dir, content)
+
+        # Attachments can be added or replaced without the page version
+        # changing, so they are listed even when the page is unchanged
+        attachments = self.pull_attachments(page_id, page_dir, storage, local)
+        attachment_stats, attachment_versions = attachments or ({}, {})
+
+        # Save the metadata, unless neither the page nor its attachments
+        # changed. It records whether the attachments all came down, so a
+        # failed download is retried by the next pull.
+        if (
+            unchanged
+            and attachments is not None
+            and local.get('attachments_complete')
+            and local.get('attachment_stats') == attachment_stats
+            and local.get('attachment_versions') == attachment_versions
+        ):
+            logger.debug("Page %s is unchanged, skipping", page_id)
+            storage.set_id(page_id, str(page_dir))
+            return page_dir
+
+        storage.save_page_metadata(
+            page_dir,
+            {
+                **metadata,
+                'content_hash': digest,
+                'attachments_complete': attachments is not None,
+                'attachment_stats': attachment_stats,
+                'attachment_versions': attachment_versions,
+            },
+        )
 
         return page_dir
 
+    def get_page_content(self, page_id: str, metadata: dict) -> str:
+        """
+        Get the storage-format content of a page.
+
+        The content is taken from the cache when the page version is
+        already cached, then from the page metadata if the body was
+        expanded, and only fetched from Confluence as a last resort.
+
+        Args:
+            page_id: The ID of the page.
+            metadata: The metadata of the page, including its version.
+
+        Returns:
+            The HTML content of the page.
+        """
+        version = metadata['version']['number']
+        if self.cache:
+            content = self.cache.get(page_id, version)
+            if content is not None:
+                return content
+
+        body = metadata.get('body', {}).get('storage')
+        if body is None:
+            page = self.client.get_page_by_id(page_id, expand=BODY_EXPAND)
+            body = page['body']['storage']
+
+        content = body['value']
+        if self.cache:
+            self.cache.put(page_id, version, content)
+
+        return content
+
     def pull_page_tree(
         self, page_id: str, storage: LocalStorage, parent_dir: Optional[Path] = None
     ) -> Path:
@@ -108,30 +234,155 @@ class PullOperations:
         Returns:
             The path to the page directory.
         """
-        # Get the page with all necessary expansions
-        page = self.client.get_page_by_id(
-            page_id,
-            expand="body.storage,version,space,metadata.properties.editor,metadata.properties.emoji_title_published,children.page"
-        )
+        if self.recurse:
+            # The page and all its descendants come back from one search
+            page, tree = self.fetch_subtree(page_id, storage)
+        else:
+            page = self.client.get_page_by_id(page_id, expand=self.page_expand)
 
         # Check if the page exists locally and if it has been renamed
-        local_dir = storage.get_page_dir_by_id(page_id)
-        if local_dir:
-            metadata = storage.get_page_metadata(local_dir)
-            if metadata and metadata['title'] != page['title']:
-                # Handle rename
-                logger.info(f"Detected renamed page: {metadata['title']} -> {page['title']}")
-                local_dir = self.handle_renamed_page(page_id, page['title'], storage)
-
-        # Pull the page itself
+        metadata = storage.get_page_metadata_by_id(page_id)
+        if metadata and metadata['title'] != page['title']:
+            # Handle rename
+            logger.info(
+                "Detected renamed page: %s -> %s", metadata['title'], page['title']
+            )
+            self.handle_renamed_page(page_id, page['title'], storage)
+
+        # Pull the page itself, counting its attachments towards the failures
+        # that keep the subtree digests from being recorded
+        self.attachments_failed = False
         page_dir = self.pull_page(page_id, storage, parent_dir, metadata=page)
 
         # Pull children if recursive mode is enabled
         if self.recurse:
-            self.pull_children(page_id, storage, page_dir)
+            hashes = self.compute_subtree_hashes(page, tree)
+            self.pull_children(page_id, storage, page_dir, tree, hashes)
+
+            # Remember which subtrees are now complete on disk, so unchanged
+            # ones can be skipped next time. Failed attachment downloads
+            # aren't retried otherwise, so nothing is recorded after one.
+            if not self.dry_run and not self.attachments_failed:
+                storage.set_subtree_hashes(
+                    {pid: digest for pid, (digest, _) in hashes.items()}
+                )
 
         return page_dir
 
+    def compute_subtree_hashes(
+        self, root: Dict, tree: Dict[str, List[Dict]]
+    ) -> Dict[str, Tuple[str, int]]:
+        """
+        Compute a digest of the subtree below every page in a tree.
+
+        A page's digest covers its ID, version and parent, and the digests
+        of its children, so it changes whenever any page below it is edited,
+        renamed, added, removed or moved.
+
+        Args:
+            root: The metadata of the root page.
+            tree: The mapping of parent page ID to child pages.
+
+        Returns:
+            The digest and page count of each subtree, keyed by page ID.
+        """
+        # List the pages breadth-first, so every page comes after its parent
+        order = [root]
+        for page in order:
+            order.extend(tree.get(page['id'], []))
+
+        hashes = {}
+        for page in reversed(order):
+            ancestors = page.get('ancestors') or [{'id': ''}]
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(
+                f"{page['id']}:{page['version']['number']}:{ancestors[-1]['id']}".encode()
+            )
+            size = 1
+            for child_digest, child_size in sorted(
+                hashes[child['id']] for child in tree.get(page['id'], [])
+            ):
+                digest.update(child_digest.encode())
+                size += child_size
+            hashes[page['id']] = (digest.hexdigest(), size)
+
+        return hashes
+
+    def fetch_subtree(
+        self, page_id: str, storage: Optional[LocalStorage] = None
+    ) -> Tuple[Dict, Dict[str, List[Dict]]]:
+        """
+        Fetch a page and every descendant with a single paginated search.
+
+        Args:
+            page_id: The ID of the root page.
+            storage: Optional local storage. Bodies are only fetched for
+                pages whose version isn't already stored in it.
+
+        Returns:
+            The metadata of the root page, and a mapping of parent page ID to
+            the metadata of its child pages.
+        """
+        root = None
+        tree = {}
+        for page in search_content(
+            self.client,
+            f"(id={page_id} or ancestor={page_id}) and type=page",
+            expand=f"{self.page_expand},ancestors",
+            prefetcher=self.prefetcher,
+        ):
+            if page["id"] == page_id:
+                root = page
+                continue
+
+            # The last ancestor is always the direct parent
+            parent_id = page["ancestors"][-1]["id"]
+            tree.setdefault(parent_id, []).append(page)
+
+        if root is None:
+            raise ValueError(f"Page {page_id} not found")
+
+        self.fetch_missing_bodies(
+            [root] + [child for children in tree.values() for child in children],
+            storage,
+        )
+
+        return root, tree
+
+    def fetch_missing_bodies(
+        self, pages: List[Dict], storage: Optional[LocalStorage] = None
+    ) -> None:
+        """
+        Fill in the bodies of pages whose version is not already available.
+
+        Pages whose version is in the cache, or already stored locally, are
+        skipped. The remaining bodies are fetched in batches with an
+        ``id in (...)`` search rather than one request per page.
+
+        Args:
+            pages: The page metadata to update in place.
+            storage: Optional local storage to check for stored versions.
+        """
+        missing = {}
+        for page in pages:
+            version = page["version"]["number"]
+            if self.cache and self.cache.contains(page["id"], version):
+                continue
+            if storage and storage.get_page_version(page["id"]) == version:
+                continue
+            missing[page["id"]] = page
+
+        ids = list(missing)
+        for start in range(0, len(ids), BODY_BATCH_SIZE):
+            batch = ",".join(ids[start:start + BODY_BATCH_SIZE])
+            for result in search_content(
+                self.client,
+                f"id in ({batch})",
+                expand=BODY_EXPAND,
+                prefetcher=self.prefetcher,
+            ):
+                missing[result["id"]]["body"] = result["body"]
+
     def collect_all_child_pages(self, page_id: str) -> List[Dict]:
         """
         Recursively collect all child pages of a page.
@@ -142,77 +393,117 @@ class PullOperations:
         Returns:
             A list of all child pages.
         """
-        result = []
-        
-        # Get direct child pages
-        children = self.client.get_child_pages(page_id=page_id)
-        result.extend(children)
-        
-        # If recursive mode is enabled, get children of children
-        if self.recurse:
-            for child in children:
-                result.extend(self.collect_all_child_pages(child['id']))
-                
-        return result
+        if not self.recurse:
+            return list(self.client.get_child_pages(page_id=page_id))
+
+        # Only the listing is needed, so skip the body fetch in fetch_subtree
+        return list(search_content(
+            self.client,
+            f"ancestor={page_id} and type=page",
+            expand=f"{self.page_expand},ancestors",
+            prefetcher=self.prefetcher,
+        ))
     
     def pull_children(
-        self, page_id: str, storage: LocalStorage, parent_dir: Path
+        self,
+        page_id: str,
+        storage: LocalStorage,
+        parent_dir: Path,
+        tree: Dict[str, List[Dict]],
+        hashes: Optional[Dict[str, Tuple[str, int]]] = None,
     ) -> None:
         """
-        Pull all child pages of a page.
+        Pull all descendants of a page.
+
+        Pages are pulled breadth-first by the worker pool. As soon as a page
+        has been written, its own children are queued with its directory as
+        their parent, so workers stay busy without waiting for whole levels
+        of the tree to finish. When trusting versions, subtrees whose digest
+        matches the one stored by the last complete pull are skipped
+        entirely.
 
         Args:
             page_id: The ID of the parent page.
             storage: The local storage to save to.
             parent_dir: The parent directory to save in.
+            tree: The prefetched mapping of parent page ID to child pages.
+                Entries are removed as their pages are queued.
+            hashes: Optional subtree digests, as from compute_subtree_hashes.
         """
         if self.dry_run:
-            logger.info(f"Would pull children of page {page_id}")
+            logger.info("Would pull children of page %s", page_id)
             return
 
-        # Get all child pages (direct children only, we'll handle recursion differently)
-        # Convert to list to ensure we can get the length
-        children = list(self.client.get_child_pages(page_id=page_id))
-        
-        if not children:
+        total = sum(len(children) for children in tree.values())
+        if not total:
             return
-            
-        # Process each child page
-        for i, child in enumerate(children):
-            # Use a simple progress message instead of tqdm
-            if self.show_progress:
-                # Get the parent page title
-                parent_title = "Unknown"
-                try:
-                    parent_page = self.client.get_page_by_id(page_id, expand="title")
-                    parent_title = parent_page.get('title', 'Unknown')
-                except:
-                    pass
-                
-                # Clear the line and write the progress with parent info
-                sys.stdout.write(f"\rPulling child pages of '{parent_title}': {i+1}/{len(children)}")
-                sys.stdout.flush()
-                
-            # Pull the page and its children
-            child_dir = self.pull_page(child['id'], storage, parent_dir)
-            
-            # Recursively pull children if needed
-            if self.recurse:
-                self.pull_children(child['id'], storage, child_dir)
-                
-        # Print a newline after we're done
-        if self.show_progress and children:
-            # Get the parent page title if we haven't already
-            if 'parent_title' not in locals():
-                parent_title = "Unknown"
-                try:
-                    parent_page = self.client.get_page_by_id(page_id, expand="title")
-                    parent_title = parent_page.get('title', 'Unknown')
-                except Exception as e:
-                    logger.debug(f"Failed to get parent title: {e}")
-                    
-            sys.stdout.write(f"\rPulling child pages of '{parent_title}': {len(children)}/{len(children)} - Complete\n")
-            sys.stdout.flush()
+
+        pending = {}
+
+        def submit_children(parent_id: str, page_dir: Path) -> int:
+            # Returns the number of pages in the subtrees that were skipped.
+            # Children are popped from the tree as they are queued, so each
+            # page's metadata (and body) is released once it is written.
+            skipped = 0
+            for child in tree.pop(parent_id, []):
+                if self.trust_versions and hashes and self.is_subtree_unchanged(
+                    child, page_dir, storage, hashes[child['id']][0]
+                ):
+                    skipped += hashes[child['id']][1]
+                    continue
+
+                future = self.executor.submit(
+                    self.pull_page, child['id'], storage, page_dir, metadata=child
+                )
+                pending[future] = child
+            return skipped
+
+        progress = tqdm(
+            total=total,
+            desc="Pulling child pages",
+            unit="page",
+            disable=not self.show_progress,
+        )
+        with progress:
+            progress.update(submit_children(page_id, parent_dir))
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        child = pending.pop(future)
+                        child_dir = future.result()
+                        progress.update(1)
+
+                        # Queue the children of the page that was just written
+                        if self.recurse:
+                            progress.update(submit_children(child['id'], child_dir))
+            except BaseException:
+                # Don't leave queued pages running after a failure
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def is_subtree_unchanged(
+        self, page: Dict, parent_dir: Path, storage: LocalStorage, digest: str
+    ) -> bool:
+        """
+        Check whether a page and its descendants are already pulled.
+
+        Args:
+            page: The metadata of the page.
+            parent_dir: The directory of the page's parent.
+            storage: The local storage to check.
+            digest: The digest of the page's remote subtree.
+
+        Returns:
+            True if the subtree matches the last complete pull and is still
+            on disk, False otherwise.
+        """
+        if storage.get_subtree_hash(page['id']) != digest:
+            return False
+
+        # The subtree must still be where it would be written
+        return storage.get_child_dir(parent_dir, page['title']).is_dir()
 
     def handle_renamed_page(
         self, page_id: str, new_title: str, storage: LocalStorage
@@ -238,10 +529,15 @@ class PullOperations:
         # Get the current title from metadata
         metadata = storage.get_page_metadata(current_dir)
         old_title = metadata['title']
+        safe_title = storage._sanitize_filename(new_title)
+
+        # Nothing to do if the page already has this title and directory
+        if old_title == new_title and current_dir.name == safe_title:
+            return current_dir
 
         # Update the metadata with the new title
-        metadata['title'] = new_title
-        storage.save_page_metadata(current_dir, metadata)
+        if old_title != new_title:
+            storage.save_page_metadata(current_dir, {**metadata, 'title': new_title})
 
         # Determine if this is a child page
         is_child = "children" in str(current_dir)
@@ -249,56 +545,101 @@ class PullOperations:
         # Get the appropriate parent directory
         if is_child:
             parent_dir = current_dir.parent.parent  # Go up two levels: children/old_name -> parent
-            new_dir = parent_dir / "children" / storage._sanitize_filename(new_title)
+            new_dir = parent_dir / "children" / safe_title
         else:
             parent_dir = current_dir.parent
-            new_dir = parent_dir / storage._sanitize_filename(new_title)
+            new_dir = parent_dir / safe_title
 
         # If the new directory already exists, handle it
         if new_dir.exists() and new_dir != current_dir:
             # Create a unique name by appending the page ID
-            new_dir = parent_dir / f"{storage._sanitize_filename(new_title)}_{page_id}"
+            new_dir = parent_dir / f"{safe_title}_{page_id}"
 
         # Only rename if the directory name would actually change
         if current_dir != new_dir:
             # Create parent directories if needed
-            new_dir.parent.mkdir(parents=True, exist_ok=True)
-            current_dir.rename(new_dir)
+            storage.make_dir(new_dir.parent)
+            os.replace(current_dir, new_dir)
             logger.info(
-                f"Renamed directory from '{current_dir.name}' to '{new_dir.name}'"
-                " to match remote title change"
+                "Renamed directory from '%s' to '%s' to match remote title change",
+                current_dir.name,
+                new_dir.name,
             )
 
         # Update the ID map
-        storage.update_id_map(page_id, str(new_dir))
+        storage.set_id(page_id, str(new_dir))
 
         return new_dir
 
     def pull_attachments(
-        self, page_id: str, page_dir: Path
-    ) -> None:
+        self,
+        page_id: str,
+        page_dir: Path,
+        storage: Optional[LocalStorage] = None,
+        local: Optional[Dict] = None,
+    ) -> Optional[Tuple[Dict[str, List[int]], Dict[str, int]]]:
         """
         Pull the attachments of a page.
 
+        Attachments whose version was already downloaded by the last pull,
+        and which are still on disk, are not downloaded again.
+
         Args:
             page_id: The ID of the page.
-            storage: The local storage to save to.
             page_dir: The page directory.
+            storage: Optional local storage, used to create directories.
+            local: Optional metadata of the page as of the last pull.
+
+        Returns:
+            The modification time (in ns) and size of each file as written,
+            and the version of each attachment, both keyed by name, or None
+            if a download failed.
         """
         # Create the attachments directory
         attachments_dir = page_dir / "attachments"
-        attachments_dir.mkdir(parents=True, exist_ok=True)
+        if storage:
+            storage.make_dir(attachments_dir)
+        else:
+            attachments_dir.mkdir(parents=True, exist_ok=True)
 
         if self.dry_run:
-            logger.info(f"Would download attachments for page {page_id}")
-            return
+            logger.info("Would download attachments for page %s", page_id)
+            return {}, {}
+
+        pulled_stats = (local or {}).get('attachment_stats', {})
+        pulled_versions = (local or {}).get('attachment_versions', {})
+
+        def pull(attachment: Dict) -> Tuple[str, Optional[int], List[int]]:
+            name = attachment['title']
+            version = attachment.get('version', {}).get('number')
+            if (
+                version is not None
+                and pulled_versions.get(name) == version
+                and name in pulled_stats
+                and os.path.exists(os.path.join(attachments_dir, name))
+            ):
+                return name, version, pulled_stats[name]
+
+            # Record the file as written, so a push can tell it is unchanged
+            stat = os.stat(download_attachment(
+                self.client, attachment, str(attachments_dir)
+            ))
+            return name, version, [stat.st_mtime_ns, stat.st_size]
 
-        # Use the download_attachments_from_page method to download everything
-        # This is more reliable than downloading individual attachments
         try:
-            # Download all attachments to the attachments directory
-            self.client.download_attachments_from_page(page_id, str(attachments_dir))
-            logger.info(f"Downloaded attachments for page {page_id}")
+            # Stream the attachments straight to disk concurrently
+            results = list(self.attachment_executor.map(
+                pull, iter_attachments(self.client, page_id, self.prefetcher)
+            ))
+            logger.info("Pulled attachments for page %s", page_id)
 
         except Exception as e:
-            logger.error(f"Failed to download attachments: {e}")
+            logger.error("Failed to download attachments: %s", e)
+            self.attachments_failed = True
+            return None
+
+        stats = {name: stat for name, _, stat in results}
+        versions = {
+            name: version for name, version, _ in results if version is not None
+        }
+        return stats, versions
@@ -6,15 +6,30 @@ Push operations for csync.
 This module provides functionality for pushing local content to Confluence.
 """
 
+import itertools
 import logging
-import sys
-from pathlib import Path
-from src.fs import LocalStorage
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Any, Dict, List, Optional, Tuple
+from tqdm import tqdm
+from src.client import (
+    ATTACHMENT_BATCH_SIZE,
+    search_content,
+    update_page,
+    upload_attachments,
+)
+from src.fs import LocalStorage, content_hash
+from src.pull import DEFAULT_CONCURRENCY
 from atlassian import Confluence
-import json
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of titles looked up in a single search
+TITLE_BATCH_SIZE = 50
+
+# The page property holding the emoji shown with a page's published title
+EMOJI_PROP_KEY = "emoji-title-published"
+
 
 class PushOperations:
     """Operations for pushing local content to Confluence."""
@@ -25,6 +40,8 @@ class PushOperations:
         show_progress: bool = True,
         recurse: bool = True,
         dry_run: bool = False,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        force: bool = False,
     ):
         """
         Initialize the push operations.
@@ -34,14 +51,127 @@ class PushOperations:
             show_progress: Whether to show progress bars.
             recurse: Whether to recursively process child pages.
             dry_run: Whether to perform a dry run (no changes).
+            concurrency: The maximum number of pages pushed at once.
+            force: Whether to push pages and attachments even if they are
+                unchanged since the last push.
         """
         self.client = client
         self.show_progress = show_progress
         self.recurse = recurse
         self.dry_run = dry_run
+        self.concurrency = concurrency
+        self.force = force
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Attachments are uploaded from within page workers, so they get
+        # their own pool rather than waiting on tasks in the page pool
+        self.attachment_executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Later pages of paginated listings are requested on a single shared
+        # thread, rather than one per listing
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+        # Pages looked up during this run, keyed by ID
+        self._page_cache: Dict[str, Dict[str, Any]] = {}
+
+        # Pages in the destination space looked up by title in bulk, or
+        # None for titles that don't exist there
+        self._titles: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    def close(self) -> None:
+        """Shut down the worker pools, waiting for any running tasks."""
+        self.executor.shutdown()
+        self.attachment_executor.shutdown()
+        self.prefetcher.shutdown()
+
+    def get_page(self, page_id: str) -> Dict[str, Any]:
+        """
+        Get a page with its space and version, fetching it at most once.
+
+        Args:
+            page_id: The ID of the page.
+
+        Returns:
+            The page.
+        """
+        page = self._page_cache.get(page_id)
+        if page is None:
+            page = self.client.get_page_by_id(page_id, expand="space,version")
+            self._page_cache[page_id] = page
+
+        return page
+
+    def fetch_remote_tree(self, page_id: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """
+        Fetch the IDs and versions of all pages below a page in bulk.
+
+        Args:
+            page_id: The ID of the page the tree is pushed under.
+
+        Returns:
+            The existing pages keyed by their parent ID and title.
+        """
+        remote = {}
+        for page in search_content(
+            self.client,
+            f"ancestor={page_id} and type=page",
+            expand="version,ancestors",
+            prefetcher=self.prefetcher,
+        ):
+            parent_id = page["ancestors"][-1]["id"]
+            remote[(parent_id, page["title"])] = page
+
+        return remote
+
+    def find_pages_by_title(
+        self, space: str, titles: List[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Look up pages in a space by title, in bulk.
+
+        Args:
+            space: The key of the space.
+            titles: The titles of the pages.
+
+        Returns:
+            The pages that exist, with their versions, keyed by title.
+        """
+        found = {}
+        for i in range(0, len(titles), TITLE_BATCH_SIZE):
+            quoted = ", ".join(
+                '"' + title.replace("\\", "\\\\").replace('"', '\\"') + '"'
+                for title in titles[i:i + TITLE_BATCH_SIZE]
+            )
+            for page in search_content(
+                self.client,
+                f'space="{space}" and type=page and title in ({quoted})',
+                expand="version",
+                prefetcher=self.prefetcher,
+            ):
+                found[page["title"]] = page
+
+        return found
+
+    def remote_body_matches(self, page_id: str, digest: str) -> bool:
+        """
+        Check whether the current body of a page on Confluence has a digest.
+
+        Args:
+            page_id: The ID of the page.
+            digest: The digest of the content, as returned by content_hash.
+
+        Returns:
+            True if the page's body has the digest.
+        """
+        page = self.client.get_page_by_id(page_id, expand="body.storage")
+        return content_hash(page["body"]["storage"]["value"]) == digest
 
     def push_page(
-        self, storage: LocalStorage, local_dir: Path, parent_id: str = None
+        self,
+        storage: LocalStorage,
+        local_dir: str,
+        parent_id: str = None,
+        remote: Optional[Dict[Tuple[str, str], Dict[str, Any]]] = None,
     ) -> str:
         assert local_dir is not None and parent_id is not None
         """
@@ -50,6 +180,7 @@ class PushOperations:
             storage: The local storage to read from.
             local_dir: The local directory containing the page.
             parent_id: Optional ID of the parent page.
+            remote: Optional existing pages, as returned by fetch_remote_tree.
         Returns:
             The ID of the created/updated page.
         """
@@ -57,94 +188,175 @@ class PushOperations:
         metadata = storage.get_page_metadata(local_dir)
         assert content != "" and content is not None
         assert "title" in metadata
-        logger.debug(f"[push_page]: local_dir: {local_dir}, parent_id: {parent_id}")
-        if self.dry_run:
-            logger.info(f"[DRY RUN]: push_page({local_dir}, {parent_id})")
+        logger.debug("[push_page]: local_dir: %s, parent_id: %s", local_dir, parent_id)
         created_page = None
+        existing = (remote or {}).get((parent_id, metadata["title"]))
+        digest = content_hash(content)
+        properties = metadata.get("metadata", {}).get("properties")
+
+        # Compare against the last push, or failing that the last pull
+        state = storage.get_push_state(local_dir)
+        pulled = state is None and "id" in metadata
+        if pulled:
+            state = {
+                "id": metadata["id"],
+                "version": metadata.get("version", {}).get("number"),
+                "content_hash": metadata.get("content_hash"),
+                "properties": properties,
+                "attachments": dict(metadata.get("attachment_stats", {})),
+            }
+        known = (
+            existing
+            and state
+            and state["id"] == existing["id"]
+            and state["version"] == existing["version"]["number"]
+        )
+        if (
+            not self.force
+            and known
+            and state["content_hash"] == digest
+            and state.get("properties") == properties
+        ):
+            # Neither side changed since, so the page needn't be sent again
+            logger.debug("Page %s is unchanged, skipping", existing["id"])
+            if pulled and not self.dry_run:
+                # Keep the state taken from the pull, so the attachments it
+                # downloaded are recognised as unchanged and uploads recorded
+                storage.set_push_state(local_dir, state)
+            self.push_attachments(existing["id"], local_dir, storage)
+            return existing["id"]
+
+        if self.dry_run:
+            # Report the change from the remote tree alone, without the
+            # lookups that only serve to send it
+            if existing:
+                logger.info("[DRY RUN]: would update page %s from %s", existing["id"], local_dir)
+                page_id = existing["id"]
+            else:
+                logger.info(
+                    "[DRY RUN]: would create page '%s' from %s", metadata["title"], local_dir
+                )
+                # The page has no ID yet, so its directory stands in for one;
+                # it can't match a real (numeric) ID in the remote tree
+                page_id = local_dir
+            self.push_attachments(page_id, local_dir, storage)
+            return page_id
+
         try:
-            created_page = self.client.update_or_create(
-                parent_id=parent_id,
-                title=metadata["title"],
-                body=content,
-                representation="storage",
-                minor_edit=True,
-                editor="v2",
-                full_width=True,
-            )
-            # Set emoji title published property if it exists in metadata
-            try:
-                logger.debug(f"Metadata keys: {metadata.keys()}")
-                if "metadata" in metadata and "properties" in metadata["metadata"]:
-                    properties = metadata["metadata"]["properties"]
-                    logger.debug(f"Properties found: {list(properties.keys())}")
-
-                    if "emoji-title-published" in properties:
-                        emoji_data = properties["emoji-title-published"]
-                        logger.debug(f"Emoji data found: {emoji_data}")
-
-                        # Extract the emoji value
-                        emoji_value = emoji_data.get("value")
-                        logger.debug(f"Extracted emoji value: {emoji_value}")
-
-                        if emoji_value:
-                            # Update the emoji property using the correct API method
-                            property_data = {
-                                "key": "emoji-title-published",
-                                "value": emoji_value
-                            }
-                            logger.debug(f"Setting page property with data: {property_data}")
-                            try:
-                                response = self.client.set_page_property(
-                                    created_page["id"],
-                                    property_data
-                                )
-                                logger.debug(f"Response from set_page_property: {response}")
-                            except Exception as prop_error:
-                                logger.error(f"Error setting page property: {str(prop_error)}")
-                                logger.debug("Property error details:", exc_info=True)
-                                # Try with a different format as fallback
-                                try:
-                                    logger.debug("Trying alternative property format...")
-                                    response = self.client.set_page_property(
-                                        page_id=created_page["id"],
-                                        data={"key": "emoji-title-published", "value": emoji_value}
-                                    )
-                                    logger.debug(f"Alternative format response: {response}")
-                                except Exception as alt_error:
-                                    logger.error(f"Alternative format also failed: {str(alt_error)}")
-                                    logger.debug("Alternative error details:", exc_info=True)
-                            logger.debug(
-                                f"Response from update_or_create_content_property: {response}"
-                            )
-                            logger.info(
-                                f"Updated emoji-title-published property for page {created_page['id']}"
-                            )
-                        else:
-                            logger.warning("Emoji value is missing in metadata")
-                else:
-                    logger.debug("No properties found in metadata")
-            except Exception as e:
-                logger.warning(
-                    f"Failed to update emoji-title-published property: {str(e)}"
+            if (
+                existing
+                and not known
+                and not self.force
+                and self.remote_body_matches(existing["id"], digest)
+            ):
+                # The page changed remotely, or was never synced from here,
+                # but already has this content, so don't add a new version
+                logger.debug("Page %s already has the local content", existing["id"])
+                created_page = existing
+            elif existing:
+                # The version is already known, so update without a lookup
+                created_page = update_page(
+                    self.client,
+                    existing["id"],
+                    metadata["title"],
+                    content,
+                    version=existing["version"]["number"],
+                    parent_id=parent_id,
                 )
-                logger.debug("Exception details:", exc_info=True)
+            else:
+                # Siblings share a parent, so its space is only looked up once
+                space = self.get_page(parent_id)["space"]["key"]
+                if metadata["title"] in self._titles:
+                    page = self._titles.pop(metadata["title"])
+                else:
+                    page = self.client.get_page_by_title(
+                        space, metadata["title"], expand="version"
+                    )
+                if page:
+                    # Move the page with this title under the parent
+                    created_page = update_page(
+                        self.client,
+                        page["id"],
+                        metadata["title"],
+                        content,
+                        version=page["version"]["number"],
+                        parent_id=parent_id,
+                    )
+                else:
+                    created_page = self.client.create_page(
+                        space=space,
+                        title=metadata["title"],
+                        body=content,
+                        parent_id=parent_id,
+                        representation="storage",
+                        editor="v2",
+                        full_width=True,
+                    )
+            self._page_cache.pop(created_page["id"], None)
+            # Set emoji title published property if it exists in metadata
+            emoji_value = (properties or {}).get(EMOJI_PROP_KEY, {}).get("value")
+            if emoji_value:
+                self._set_emoji_property(created_page["id"], emoji_value)
             # todo: similar to emoji but we probably need to sanitize even more fields
             # self.client.update_page_property(
             #     created_page["id"],  metadata["version"]
             # )
         except Exception as e:
-            logger.error(f"Failed to create/update page: {str(e)}", exc_info=True)
+            logger.error("Failed to create/update page: %s", e, exc_info=True)
             return ""
         # Push attachments
         assert created_page["id"] is not None
+        if not self.dry_run:
+            attachments = {}
+            if state and state["id"] == created_page["id"]:
+                attachments = state.get("attachments", {})
+            storage.set_push_state(
+                local_dir,
+                {
+                    "id": created_page["id"],
+                    "version": created_page.get("version", {}).get("number"),
+                    "content_hash": digest,
+                    "properties": properties,
+                    "attachments": attachments,
+                },
+            )
         self.push_attachments(created_page["id"], local_dir, storage)
         return created_page["id"]
 
+    def _set_emoji_property(self, page_id: str, emoji_value: str) -> None:
+        """
+        Set the emoji shown with a page's published title.
+
+        The property is set with a POST, which the client's session retries
+        with backoff when Confluence throttles it (429) or is unavailable
+        (503), honouring Retry-After. Any other failure is logged rather
+        than failing the push of the page.
+
+        Args:
+            page_id: The ID of the page.
+            emoji_value: The value of the emoji-title-published property.
+        """
+        try:
+            self.client.set_page_property(
+                page_id, {"key": EMOJI_PROP_KEY, "value": emoji_value}
+            )
+        except Exception as e:
+            logger.warning(
+                "Failed to update %s property for page %s: %s",
+                EMOJI_PROP_KEY,
+                page_id,
+                e,
+            )
+            logger.debug("Exception details:", exc_info=True)
+        else:
+            logger.info("Updated %s property for page %s", EMOJI_PROP_KEY, page_id)
+
     def push_page_tree(
         self,
         storage: LocalStorage,
-        local_dir: Path,
+        local_dir: str,
         parent_id: str = None,
+        remote: Optional[Dict[Tuple[str, str], Dict[str, Any]]] = None,
     ) -> str:
         """
         Push a page and all its children to Confluence.
@@ -153,64 +365,149 @@ class PushOperations:
             storage: The local storage to read from.
             local_dir: The local directory containing the pages.
             parent_id: Optional ID of the parent page.
+            remote: Optional existing pages, as returned by fetch_remote_tree.
+                Fetched once for the whole tree when omitted.
 
         Returns:
             The ID of the root page that was pushed.
         """
+        # List the local tree on the pool while the remote one is fetched
+        local_tree = None
+        if self.recurse:
+            local_tree = self.executor.submit(self.collect_local_tree, local_dir)
+
+        if remote is None:
+            remote = self.fetch_remote_tree(parent_id)
+
+        tree = local_tree.result() if local_tree else {}
+
+        # Read every page's metadata on the pool up front, so slow disks are
+        # read in parallel and the pushes below find it in storage's cache
+        page_dirs = [local_dir, *itertools.chain.from_iterable(tree.values())]
+        page_metadata = self.executor.map(storage.get_page_metadata, page_dirs)
+
+        # Pages missing from the remote tree may exist elsewhere in the space,
+        # so look their titles up together rather than one page at a time
+        titles = set()
+        for metadata in page_metadata:
+            if metadata and "title" in metadata:
+                titles.add(metadata["title"])
+        titles -= {title for _, title in remote}
+        self._titles = {}
+        if titles and not self.dry_run:
+            space = self.get_page(parent_id)["space"]["key"]
+            found = self.find_pages_by_title(space, sorted(titles))
+            self._titles = {title: found.get(title) for title in titles}
+
         # Push the page itself
-        print(f"[push_page_tree]: local_dir: {local_dir}, parent_id: {parent_id}")
-        page_id = self.push_page(storage, local_dir, parent_id)
+        logger.debug("[push_page_tree]: local_dir: %s, parent_id: %s", local_dir, parent_id)
+        page_id = self.push_page(storage, local_dir, parent_id, remote)
 
         # Push children if recursive mode is enabled
         if self.recurse:
-            children_dir = local_dir / "children"
-            print(f"[push_page_tree] children_dir: {children_dir}")
-            if children_dir.exists() and children_dir.is_dir():
-                # Get all child directories
-                child_dirs = [d for d in children_dir.iterdir() if d.is_dir()]
-                print(f"[push_page_tree] child_dirs: {child_dirs}")
-
-                # Process each child directory using the new parent info
-                for i, child_dir in enumerate(child_dirs):
-                    # Use a simple progress message instead of tqdm
-                    if self.show_progress:
-                        # Get the parent page title from the local directory
-                        parent_metadata = storage.get_page_metadata(local_dir)
-                        parent_title = (
-                            parent_metadata.get("title", "Unknown")
-                            if parent_metadata
-                            else "Unknown"
-                        )
+            self.push_children(page_id, local_dir, storage, tree, remote)
 
-                        # Clear the line and write the progress with parent info
-                        sys.stdout.write(
-                            f"\rPushing child pages of '{parent_title}': {i+1}/{len(child_dirs)}"
-                        )
-                        sys.stdout.flush()
-
-                    # Push child with new parent ID
-                    self.push_page_tree(storage, child_dir, page_id)
-
-                # Print a newline after we're done
-                if self.show_progress and child_dirs:
-                    # Get the parent page title if we haven't already
-                    if "parent_title" not in locals():
-                        parent_metadata = storage.get_page_metadata(local_dir)
-                        parent_title = (
-                            parent_metadata.get("title", "Unknown")
-                            if parent_metadata
-                            else "Unknown"
-                        )
+        return page_id
 
-                    sys.stdout.write(
-                        f"\rPushing child pages of '{parent_title}': {len(child_dirs)}/{len(child_dirs)} - Complete\n"
-                    )
-                    sys.stdout.flush()
+    def collect_local_tree(self, local_dir: str) -> Dict[str, List[str]]:
+        """
+        Collect the child page directories below a local page.
 
-        return page_id
+        The tree is walked with an explicit stack rather than recursion, so
+        deep trees can't run into the interpreter's recursion limit.
+
+        Args:
+            local_dir: The local directory of the root page.
+
+        Returns:
+            A mapping of page directory to the directories of its children.
+        """
+        tree = {}
+        stack = [local_dir]
+        while stack:
+            page_dir = stack.pop()
+            # Listing the directory directly saves a stat when it exists
+            try:
+                with os.scandir(os.path.join(page_dir, "children")) as entries:
+                    child_dirs = [entry.path for entry in entries if entry.is_dir()]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            logger.debug("[push_page_tree] child_dirs: %s", child_dirs)
+            tree[page_dir] = child_dirs
+            stack.extend(child_dirs)
+
+        return tree
+
+    def push_children(
+        self,
+        page_id: str,
+        local_dir: str,
+        storage: LocalStorage,
+        tree: Dict[str, List[str]],
+        remote: Dict[Tuple[str, str], Dict[str, Any]],
+    ) -> None:
+        """
+        Push all descendants of a page.
+
+        Pages are pushed by the worker pool. A page's children are queued as
+        soon as it has been pushed, since they need its ID as their parent,
+        so siblings are pushed concurrently without waiting for whole levels
+        of the tree to finish.
+
+        Args:
+            page_id: The ID of the page that was pushed from local_dir.
+            local_dir: The local directory of the parent page.
+            storage: The local storage to read from.
+            tree: The mapping of page directory to child directories.
+            remote: The existing pages, as returned by fetch_remote_tree.
+        """
+        total = sum(len(child_dirs) for child_dirs in tree.values())
+        if not total:
+            return
+
+        pending = {}
+
+        def submit_children(parent_id: str, page_dir: str) -> None:
+            for child_dir in tree.get(page_dir, []):
+                future = self.executor.submit(
+                    self.push_page, storage, child_dir, parent_id, remote
+                )
+                pending[future] = child_dir
+
+        submit_children(page_id, local_dir)
+        progress = tqdm(
+            total=total,
+            desc="Pushing child pages",
+            unit="page",
+            disable=not self.show_progress,
+        )
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    child_dir = pending.pop(future)
+                    child_id = future.result()
+                    progress.update()
+
+                    # Children can only be pushed once their parent exists
+                    if child_id:
+                        submit_children(child_id, child_dir)
+                    elif child_dir in tree:
+                        logger.warning(
+                            "Skipping the children of %s, which failed to push",
+                            child_dir,
+                        )
+        except BaseException:
+            # Don't leave queued pages running after a failure
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            progress.close()
 
     def push_attachments(
-        self, page_id: str, local_dir: Path, storage: LocalStorage = None
+        self, page_id: str, local_dir: str, storage: LocalStorage = None
     ) -> None:
         """
         Push the attachments of a page.
@@ -218,67 +515,75 @@ class PushOperations:
         Args:
             page_id: The ID of the page.
             local_dir: The local directory of the page.
+            storage: The local storage the page is read from.
         """
-        print(f"push_attachments: page_id{page_id} | local_dir: {local_dir}")
-        # Get the attachments directory
-        attachments_dir = local_dir / "attachments"
-        if not attachments_dir.exists() or not attachments_dir.is_dir():
+        logger.debug("push_attachments: page_id %s | local_dir: %s", page_id, local_dir)
+        # Get the attachment files, if the page has any
+        try:
+            with os.scandir(os.path.join(local_dir, "attachments")) as entries:
+                files = [entry for entry in entries if entry.is_file()]
+        except (FileNotFoundError, NotADirectoryError):
             return
 
-        # Get the attachments
-        attachments = [f for f in attachments_dir.iterdir() if f.is_file()]
+        # Get the attachments that changed since they were last pushed,
+        # going by their size and modification time
+        state = storage.get_push_state(local_dir) if storage else None
+        if state is None or state["id"] != page_id:
+            state = {"attachments": {}}
+        pushed = state.setdefault("attachments", {})
+        attachments = []
+        stats = {}
+        for entry in files:
+            stat = entry.stat()
+            stats[entry.path] = [stat.st_mtime_ns, stat.st_size]
+            if self.force or pushed.get(entry.name) != stats[entry.path]:
+                attachments.append(entry.path)
 
         if not attachments:
             return
 
-        # Process each attachment
-        for i, attachment_path in enumerate(attachments):
-            # Use a simple progress message instead of tqdm
-            if self.show_progress:
-                # Get the page title
-                page_metadata = storage.get_page_metadata(local_dir)
-                page_title = (
-                    page_metadata.get("title", "Unknown")
-                    if page_metadata
-                    else "Unknown"
-                )
-
-                # Clear the line and write the progress with page info
-                sys.stdout.write(
-                    f"\rUploading attachments for '{page_title}': {i+1}/{len(attachments)}"
-                )
-                sys.stdout.flush()
+        # Get the page title once for the progress bar; the metadata was
+        # already read when the page was pushed, so this is a cache hit
+        page_metadata = storage.get_page_metadata(local_dir) if storage else None
+        page_title = (page_metadata or {}).get("title", "Unknown")
 
+        def upload(batch: List[str]) -> int:
             if not self.dry_run:
-                # Read the file content and attach it to the page
-                file_name = attachment_path.name
-
-                # Attach the file to the page
-                # If the attachment already exists, it will be versioned
-                with open(attachment_path, "rb") as file:
-                    self.client.attach_content(
-                        name=file_name,
-                        comment="uploaded by csync",
-                        content=file.read(),
-                        page_id=page_id,
-                    )
+                # Stream the files to the page from disk in one request
+                # If an attachment already exists, it will be versioned
+                upload_attachments(self.client, page_id, batch)
+                for attachment_path in batch:
+                    pushed[os.path.basename(attachment_path)] = stats[attachment_path]
 
             # Log the action
             action = "Would upload" if self.dry_run else "Uploaded"
-            logger.debug(f"{action} attachment '{attachment_path.name}'")
-
-        # Print a newline after we're done
-        if self.show_progress and attachments:
-            # Get the page title if we haven't already
-            if "page_title" not in locals():
-                page_metadata = storage.get_page_metadata(local_dir)
-                page_title = (
-                    page_metadata.get("title", "Unknown")
-                    if page_metadata
-                    else "Unknown"
-                )
-
-            sys.stdout.write(
-                f"\rUploading attachments for '{page_title}': {len(attachments)}/{len(attachments)} - Complete\n"
+            for attachment_path in batch:
+                logger.debug("%s attachment '%s'", action, os.path.basename(attachment_path))
+            return len(batch)
+
+        # Upload the attachments in batches, concurrently
+        futures = [
+            self.attachment_executor.submit(
+                upload, attachments[i:i + ATTACHMENT_BATCH_SIZE]
             )
-            sys.stdout.flush()
+            for i in range(0, len(attachments), ATTACHMENT_BATCH_SIZE)
+        ]
+        progress = tqdm(
+            total=len(attachments),
+            desc=f"Uploading attachments for '{page_title}'",
+            unit="file",
+            disable=not self.show_progress,
+        )
+        try:
+            for future in as_completed(futures):
+                progress.update(future.result())
+        except BaseException:
+            # Don't leave queued uploads running after a failure
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # Record the uploads that made it, even if others failed
+            if "id" in state and not self.dry_run:
+                storage.set_push_state(local_dir, state)
+            progress.close()
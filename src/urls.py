@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+URL parsing for csync.
+
+This module provides functions for extracting page details from Confluence URLs.
+"""
+
+import logging
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class PageURL(NamedTuple):
+    """The components of a Confluence page URL."""
+
+    base_url: str
+    type: str = "page"
+    space_key: Optional[str] = None
+    page_id: Optional[str] = None
+    title: Optional[str] = None
+
+
+@lru_cache(maxsize=4096)
+def parse_page_url(url: str) -> PageURL:
+    """
+    Parse a Confluence page URL to extract space key and page title/ID.
+
+    Results are memoized, so repeated lookups of the same URL are free.
+
+    Args:
+        url: The URL of the Confluence page.
+
+    Returns:
+        The parsed components of the URL.
+    """
+    parsed = urlparse(url)
+    path_parts = parsed.path.strip("/").split("/")
+
+    base_url = f"{parsed.scheme}://{parsed.netloc}"
+    space_key = None
+    page_id = None
+    title = None
+
+    # Extract space key, page ID, and title from the URL. The space segment
+    # may follow a context path other than /wiki on self-hosted instances.
+    try:
+        spaces_idx = path_parts.index("spaces")
+    except ValueError:
+        spaces_idx = None
+
+    if spaces_idx is not None:
+        if spaces_idx + 1 < len(path_parts):
+            # Space key always follows the spaces segment
+            space_key = path_parts[spaces_idx + 1]
+
+        # Page ID and title if they exist, after the space key. The search
+        # starts past the key, which may itself be "pages".
+        try:
+            pages_idx = path_parts.index("pages", spaces_idx + 2)
+        except ValueError:
+            pages_idx = None
+        if pages_idx is not None:
+            if pages_idx + 1 < len(path_parts):
+                page_id = path_parts[pages_idx + 1]
+            if pages_idx + 2 < len(path_parts):
+                title = path_parts[pages_idx + 2]
+
+    # Handle legacy viewpage.action?pageId=... URLs
+    elif path_parts[-1] == "viewpage.action":
+        page_id = parse_qs(parsed.query).get("pageId", [None])[0]
+
+    # Handle direct API URLs (for compatibility)
+    elif (
+        len(path_parts) >= 4
+        and path_parts[0] == "rest"
+        and path_parts[1] == "api"
+        and path_parts[2] == "content"
+    ):
+        page_id = path_parts[3]
+        # We'll need to fetch the space key from the page itself later
+
+    result = PageURL(
+        base_url=base_url,
+        space_key=space_key,
+        page_id=page_id,
+        title=title,
+    )
+    logger.debug("Parsed %s -> %s", url, result)
+    return result